@@ -6,48 +6,244 @@ Reads images from the local `images/` folder, uploads them to S3, calls Amazon R
 to detect labels, and stores results in DynamoDB.
 """
 
+import hashlib
 import json
+import logging
+import mmap
 import os
+import queue
+import sys
+import threading
 from datetime import datetime, timezone
 from decimal import Decimal
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import boto3
+# boto3, botocore and urllib3 are imported inside the functions that need them.
+# Loading botocore costs a sizeable share of a short CI run, and runs that fail
+# env validation or find no images never touch AWS.
 
 
+logger = logging.getLogger("analyze_image")
+
+REQUIRED_ENV_VARS = ("AWS_REGION", "S3_BUCKET", "DYNAMODB_TABLE")
+
 IMAGES_DIR = Path("images")
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png"})
 S3_PREFIX = "rekognition-input"
+S3_KEY_PREFIX = f"{S3_PREFIX}/"
+DEFAULT_POOL_CONNECTIONS = 64
+
+# Each pipeline stage has its own pool. Rekognition's TPS quota is far lower than
+# S3's, and DynamoDB writes are batched, so those stages need fewer threads.
+DEFAULT_UPLOAD_WORKERS = 16
+DEFAULT_DETECT_WORKERS = 8
+DEFAULT_WRITE_WORKERS = 4
+
+# BatchWriteItem accepts at most 25 items per request.
+DYNAMODB_BATCH_SIZE = 25
+
+# Tells a stage worker that its inbox is exhausted.
+STAGE_DONE = object()
 
+# Files above the threshold are uploaded as concurrent multipart chunks so large
+# images fill the link instead of waiting on a single PUT.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 10
 
-def get_env_var(name: str) -> str:
+# Smaller files are PUT straight to a presigned URL over a plain urllib3 pool,
+# skipping botocore's per-request signing and handler chain in the workers.
+PRESIGNED_URL_EXPIRY = 3600
+
+
+def get_required_env_vars(names: Tuple[str, ...]) -> Dict[str, str]:
+    # Validate everything up front so a misconfigured run reports every missing
+    # variable at once, before any AWS work starts.
+    env = os.environ
+    missing = [name for name in names if not env.get(name)]
+    if missing:
+        raise ValueError(f"Missing required environment variable(s): {', '.join(missing)}")
+    return {name: env[name] for name in names}
+
+
+def get_int_env_var(name: str, default: int) -> int:
     value = os.getenv(name)
     if not value:
-        raise ValueError(f"Missing required environment variable: {name}")
-    return value
+        return default
+
+    try:
+        parsed = int(value)
+    except ValueError:
+        raise ValueError(f"Environment variable {name} must be an integer, got: {value!r}") from None
+
+    if parsed < 1:
+        raise ValueError(f"Environment variable {name} must be >= 1, got: {parsed}")
+    return parsed
+
+
+def build_client_config(workers: int) -> Any:
+    from botocore.config import Config
+
+    # botocore keeps 10 connections per client by default; with more workers than
+    # that, connections get discarded and every request pays a new TLS handshake.
+    return Config(
+        max_pool_connections=max(DEFAULT_POOL_CONNECTIONS, workers),
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        tcp_keepalive=True,
+        connect_timeout=10,
+        read_timeout=60,
+    )
+
+
+def build_s3_config(client_config: Any) -> Any:
+    from botocore.config import Config
+
+    # Presigned URLs are signed with the client's config. Left to the defaults,
+    # botocore can still emit SigV2 URLs on the global endpoint, which buckets
+    # created since 2020 reject; force SigV4 and the regional virtual host.
+    return client_config.merge(Config(signature_version="s3v4", s3={"addressing_style": "virtual"}))
+
+
+def build_transfer_config() -> Any:
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=MULTIPART_CONCURRENCY,
+        use_threads=True,
+    )
+
+
+def build_upload_pool(maxsize: int) -> Any:
+    import urllib3
+
+    return urllib3.PoolManager(
+        num_pools=1,
+        maxsize=maxsize,
+        retries=urllib3.Retry(total=5, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)),
+    )
+
+
+def configure_logging() -> None:
+    # LOG_LEVEL applies to this script's logger only; the root stays at WARNING so
+    # botocore's INFO chatter stays out of CI logs.
+    logging.basicConfig(format="%(message)s")
+
+    level_name = os.getenv("LOG_LEVEL", "INFO").upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        logger.setLevel(logging.INFO)
+        logger.warning("Unknown LOG_LEVEL %r, using INFO", level_name)
+        return
+    logger.setLevel(level)
 
 
 def list_image_files(images_dir: Path) -> List[Path]:
     if not images_dir.exists():
-        print(f"ℹ️ No '{images_dir}' folder found.")
+        logger.info("ℹ️ No '%s' folder found.", images_dir)
         return []
 
-    image_files: List[Path] = []
-    for ext in ("*.jpg", "*.jpeg", "*.png"):
-        image_files.extend(images_dir.glob(ext))
+    # Single directory pass; extensions are matched case-insensitively.
+    with os.scandir(images_dir) as entries:
+        image_files = [
+            Path(entry.path)
+            for entry in entries
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+
+    image_files.sort()
+    return image_files
+
+
+def file_etag(file_path: Path) -> str:
+    # Reproduces the ETag S3 assigns to our uploads. Single-PUT objects get the
+    # MD5 of the body; multipart ones get the MD5 of the concatenated per-part
+    # MD5s plus "-<parts>", using the same threshold and chunk size as upload_file.
+    part_digests: List[bytes] = []
+    with file_path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size < MULTIPART_THRESHOLD:
+            digest = hashlib.md5(usedforsecurity=False)
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+            return digest.hexdigest()
+
+        for part in iter(lambda: f.read(MULTIPART_CHUNKSIZE), b""):
+            part_digests.append(hashlib.md5(part, usedforsecurity=False).digest())
+
+    combined = hashlib.md5(b"".join(part_digests), usedforsecurity=False)
+    return f"{combined.hexdigest()}-{len(part_digests)}"
+
+
+def s3_key_for(file_path: Path) -> str:
+    return S3_KEY_PREFIX + file_path.name
+
 
-    return sorted(image_files)
+def presign_upload_url(s3_client: Any, bucket: str, s3_key: str) -> str:
+    return s3_client.generate_presigned_url(
+        "put_object",
+        Params={"Bucket": bucket, "Key": s3_key},
+        ExpiresIn=PRESIGNED_URL_EXPIRY,
+    )
 
 
-def upload_to_s3(s3_client: Any, bucket: str, file_path: Path) -> str:
-    s3_key = f"{S3_PREFIX}/{file_path.name}"
-    print(f"⬆️ Uploading {file_path} to s3://{bucket}/{s3_key}")
-    s3_client.upload_file(str(file_path), bucket, s3_key)
+def get_s3_etag(s3_client: Any, bucket: str, s3_key: str) -> Optional[str]:
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=s3_key)
+    except s3_client.exceptions.ClientError:
+        return None
+    return response["ETag"].strip('"')
+
+
+def get_stored_labels(dynamodb_table: Any, s3_key: str, etag: str) -> Optional[List[Dict[str, Any]]]:
+    # The stored record is only a cache: if it cannot be read (missing
+    # dynamodb:GetItem permission, throttling), fall back to calling Rekognition.
+    try:
+        response = dynamodb_table.get_item(Key={"filename": s3_key})
+    except dynamodb_table.meta.client.exceptions.ClientError as exc:
+        logger.warning("⚠️ Could not read stored labels for %s, calling Rekognition: %s", s3_key, exc)
+        return None
+
+    item = response.get("Item")
+    if not item or item.get("etag") != etag:
+        return None
+    return item.get("labels", [])
+
+
+def upload_to_s3(
+    s3_client: Any,
+    http: Any,
+    bucket: str,
+    file_path: Path,
+    transfer_config: Any,
+    presigned_url: Optional[str] = None,
+) -> str:
+    s3_key = s3_key_for(file_path)
+    logger.info("⬆️ Uploading %s to s3://%s/%s", file_path, bucket, s3_key)
+
+    if presigned_url is None:
+        s3_client.upload_file(str(file_path), bucket, s3_key, Config=transfer_config)
+        return s3_key
+
+    # Map the file instead of reading it into a bytes copy. It is sent as a
+    # memoryview: http.client hands buffers to a single sendall(), whereas file-like
+    # bodies (mmap included) are copied through in 8 KiB blocks.
+    with file_path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            response = http.request("PUT", presigned_url, body=b"")
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as body:
+                response = http.request("PUT", presigned_url, body=body)
+
+    if response.status != 200:
+        raise RuntimeError(f"S3 PUT for {s3_key} failed with HTTP {response.status}: {response.data[:200]!r}")
     return s3_key
 
 
 def detect_labels(rekognition_client: Any, bucket: str, s3_key: str) -> List[Dict[str, Any]]:
-    print(f"👁️ Calling Rekognition detect_labels for s3://{bucket}/{s3_key}")
+    logger.info("👁️ Calling Rekognition detect_labels for s3://%s/%s", bucket, s3_key)
 
     response = rekognition_client.detect_labels(
         Image={"S3Object": {"Bucket": bucket, "Name": s3_key}},
@@ -55,98 +251,273 @@ def detect_labels(rekognition_client: Any, bucket: str, s3_key: str) -> List[Dic
         MinConfidence=70,  # int (not float)
     )
 
-    labels: List[Dict[str, Any]] = []
-    for label in response.get("Labels", []):
-        labels.append(
-            {
-                "Name": label.get("Name", "Unknown"),
-                "Confidence": Decimal(str(label.get("Confidence", 0.0))),
-            }
-        )
-
-    return labels
-
-
-def convert_floats_to_decimal(value: Any) -> Any:
-    # DynamoDB (boto3) does not support float. Convert all floats recursively.
-    if isinstance(value, float):
-        return Decimal(str(value))
-
-    if isinstance(value, list):
-        return [convert_floats_to_decimal(v) for v in value]
-
-    if isinstance(value, dict):
-        return {k: convert_floats_to_decimal(v) for k, v in value.items()}
-
-    return value
+    # DynamoDB (boto3) does not support float, so confidences are built as Decimal
+    # here and the labels can be written as-is.
+    return [
+        {
+            "Name": label.get("Name", "Unknown"),
+            "Confidence": Decimal(f"{label.get('Confidence', 0.0):.4f}"),
+        }
+        for label in response.get("Labels", [])
+    ]
 
 
 def write_to_dynamodb(
-    dynamodb_table: Any,
+    batch_writer: Any,
     s3_key: str,
     labels: List[Dict[str, Any]],
+    etag: str,
     timestamp: str,
     branch: str,
-) -> None:
+) -> Dict[str, Any]:
     item = {
         "filename": s3_key,
         "labels": labels,
+        "etag": etag,
         "timestamp": timestamp,
         "branch": branch,
     }
 
-    safe_item = convert_floats_to_decimal(item)
+    logger.info("🧾 Writing results to DynamoDB for %s", s3_key)
+    batch_writer.put_item(Item=item)
+    return item
+
+
+class PendingLabels:
+    """Labels for one content ETag, filled in by the first job that looks them up."""
+
+    def __init__(self) -> None:
+        self._done = threading.Event()
+        self._labels: List[Dict[str, Any]] = []
+        self._error: Optional[Exception] = None
+
+    def set_labels(self, labels: List[Dict[str, Any]]) -> None:
+        self._labels = labels
+        self._done.set()
+
+    def set_error(self, error: Exception) -> None:
+        self._error = error
+        self._done.set()
+
+    def wait(self) -> List[Dict[str, Any]]:
+        self._done.wait()
+        if self._error is not None:
+            raise RuntimeError(f"Label lookup for identical content failed: {self._error}") from self._error
+        return self._labels
+
+
+def run_stage_worker(
+    handler: Callable[[Dict[str, Any]], Dict[str, Any]],
+    inbox: queue.Queue,
+    outbox: Optional[queue.Queue],
+) -> None:
+    while True:
+        job = inbox.get()
+        if job is STAGE_DONE:
+            return
+
+        try:
+            result = handler(job)
+        except Exception as exc:
+            logger.error("❌ Failed processing %s: %s", job["image"].name, exc)
+            continue
+
+        if outbox is not None:
+            outbox.put(result)
+
+
+def start_stage(target: Callable[..., None], worker_args: List[Tuple[Any, ...]]) -> List[threading.Thread]:
+    threads = [threading.Thread(target=target, args=args, daemon=True) for args in worker_args]
+    for thread in threads:
+        thread.start()
+    return threads
+
 
-    print(f"🧾 Writing results to DynamoDB for {s3_key}")
-    dynamodb_table.put_item(Item=safe_item)
+def stop_stage(inbox: queue.Queue, threads: List[threading.Thread]) -> None:
+    for _ in threads:
+        inbox.put(STAGE_DONE)
+    for thread in threads:
+        thread.join()
 
 
 def main() -> None:
-    aws_region = get_env_var("AWS_REGION")
-    s3_bucket = get_env_var("S3_BUCKET")
-    dynamodb_table_name = get_env_var("DYNAMODB_TABLE")
-    branch_name = os.getenv("BRANCH_NAME", "unknown")
+    configure_logging()
 
-    print("✅ Starting Rekognition image analysis")
-    print(f"Region: {aws_region}")
-    print(f"Bucket: {s3_bucket}")
-    print(f"DynamoDB Table: {dynamodb_table_name}")
-    print(f"Branch: {branch_name}")
+    env = get_required_env_vars(REQUIRED_ENV_VARS)
+    aws_region = env["AWS_REGION"]
+    s3_bucket = env["S3_BUCKET"]
+    dynamodb_table_name = env["DYNAMODB_TABLE"]
+    branch_name = os.getenv("BRANCH_NAME", "unknown")
+    upload_workers = get_int_env_var("UPLOAD_WORKERS", DEFAULT_UPLOAD_WORKERS)
+    detect_workers = get_int_env_var("DETECT_WORKERS", DEFAULT_DETECT_WORKERS)
+    write_workers = get_int_env_var("WRITE_WORKERS", DEFAULT_WRITE_WORKERS)
 
-    session = boto3.session.Session(region_name=aws_region)
-    s3_client = session.client("s3")
-    rekognition_client = session.client("rekognition")
-    dynamodb = session.resource("dynamodb").Table(dynamodb_table_name)
+    logger.info("✅ Starting Rekognition image analysis")
+    logger.info("Region: %s", aws_region)
+    logger.info("Bucket: %s", s3_bucket)
+    logger.info("DynamoDB Table: %s", dynamodb_table_name)
+    logger.info("Branch: %s", branch_name)
+    logger.info("Workers (upload/detect/write): %d/%d/%d", upload_workers, detect_workers, write_workers)
 
     images = list_image_files(IMAGES_DIR)
     if not images:
-        print("ℹ️ No images found. Exiting.")
+        logger.info("ℹ️ No images found. Exiting.")
         return
 
-    for image in images:
-        timestamp = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    import boto3
+
+    client_config = build_client_config(upload_workers + detect_workers + write_workers)
+    # Only upload workers use S3, but each multipart upload_file runs up to
+    # MULTIPART_CONCURRENCY part uploads of its own on the shared client.
+    s3_config = build_s3_config(build_client_config(upload_workers * MULTIPART_CONCURRENCY))
+    session = boto3.session.Session(region_name=aws_region)
+    s3_client = session.client("s3", config=s3_config)
+    rekognition_client = session.client("rekognition", config=client_config)
+    # boto3 resources are not thread-safe, so every DynamoDB worker gets its own
+    # Table, created here on the main thread; they share the underlying client.
+    dynamodb = session.resource("dynamodb", config=client_config)
+    http = build_upload_pool(client_config.max_pool_connections)
+    transfer_config = build_transfer_config()
+
+    # Reruns skip unchanged work: the upload when the S3 ETag already matches the
+    # one computed locally, and Rekognition when DynamoDB holds labels for that same
+    # ETag. Labels are also cached by ETag so duplicate images in a run cost one
+    # call: the first job for an ETag claims a PendingLabels under the lock, and
+    # concurrent duplicates wait on it instead of calling Rekognition themselves.
+    label_cache: Dict[str, PendingLabels] = {}
+    label_cache_lock = threading.Lock()
+
+    # One timestamp per run: every record from the same run shares it.
+    timestamp = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    results: List[Dict[str, Any]] = []
+    results_lock = threading.Lock()
+
+    def upload_stage(job: Dict[str, Any]) -> Dict[str, Any]:
+        image, s3_key = job["image"], job["s3_key"]
+        job["etag"] = file_etag(image)
+
+        if get_s3_etag(s3_client, s3_bucket, s3_key) == job["etag"]:
+            logger.info("⏭️ s3://%s/%s is up to date, skipping upload", s3_bucket, s3_key)
+        else:
+            upload_to_s3(s3_client, http, s3_bucket, image, transfer_config, job["presigned_url"])
+        return job
+
+    def detect_stage(table: Any, job: Dict[str, Any]) -> Dict[str, Any]:
+        s3_key, etag = job["s3_key"], job["etag"]
+
+        with label_cache_lock:
+            pending = label_cache.get(etag)
+            if pending is None:
+                pending = label_cache[etag] = PendingLabels()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            logger.info("♻️ Reusing cached labels for s3://%s/%s", s3_bucket, s3_key)
+            job["labels"] = pending.wait()
+            return job
 
         try:
-            s3_key = upload_to_s3(s3_client, s3_bucket, image)
-            labels = detect_labels(rekognition_client, s3_bucket, s3_key)
-            write_to_dynamodb(dynamodb, s3_key, labels, timestamp, branch_name)
-
-            print("✅ Success")
-            print(
-                json.dumps(
-                    {
-                        "filename": s3_key,
-                        "labels": labels,
-                        "timestamp": timestamp,
-                        "branch": branch_name,
-                    },
-                    indent=2,
-                    default=str,
-                )
-            )
+            labels = get_stored_labels(table, s3_key, etag)
+            if labels is None:
+                labels = detect_labels(rekognition_client, s3_bucket, s3_key)
+            else:
+                logger.info("⏭️ Reusing stored labels for s3://%s/%s", s3_bucket, s3_key)
+        except Exception as exc:
+            # Duplicates already waiting fail with this error too; dropping the entry
+            # lets duplicates that arrive later retry the lookup.
+            with label_cache_lock:
+                del label_cache[etag]
+            pending.set_error(exc)
+            raise
+
+        pending.set_labels(labels)
+        job["labels"] = labels
+        return job
+
+    def write_worker(table: Any) -> None:
+        # Jobs are collected into batches of up to 25 and each batch is written with
+        # its own batch_writer(), which is not thread-safe and retries unprocessed
+        # items. put_item only buffers, so a record counts as processed once the
+        # writer has exited cleanly; a failed flush reports every item it held.
+        pending: List[Dict[str, Any]] = []
+
+        def flush() -> None:
+            try:
+                with table.batch_writer() as batch_writer:
+                    records = [
+                        write_to_dynamodb(
+                            batch_writer, job["s3_key"], job["labels"], job["etag"], timestamp, branch_name
+                        )
+                        for job in pending
+                    ]
+            except Exception as exc:
+                filenames = ", ".join(job["image"].name for job in pending)
+                logger.error("❌ Failed writing DynamoDB batch for %s: %s", filenames, exc)
+            else:
+                with results_lock:
+                    results.extend(records)
+                for record in records:
+                    logger.info("✅ Processed %s", record["filename"])
+            pending.clear()
+
+        while True:
+            job = write_q.get()
+            if job is STAGE_DONE:
+                break
+            pending.append(job)
+            if len(pending) == DYNAMODB_BATCH_SIZE:
+                flush()
+
+        if pending:
+            flush()
+
+    # Upload, Rekognition and DynamoDB run as separate stages joined by bounded
+    # queues, so uploads for later images overlap Rekognition calls for earlier
+    # ones and wall time tracks the slowest stage rather than the sum of all three.
+    upload_q: queue.Queue = queue.Queue(maxsize=upload_workers * 2)
+    detect_q: queue.Queue = queue.Queue(maxsize=detect_workers * 2)
+    write_q: queue.Queue = queue.Queue(maxsize=write_workers * DYNAMODB_BATCH_SIZE)
+
+    upload_threads = start_stage(run_stage_worker, [(upload_stage, upload_q, detect_q)] * upload_workers)
+    detect_threads = start_stage(
+        run_stage_worker,
+        [
+            (partial(detect_stage, dynamodb.Table(dynamodb_table_name)), detect_q, write_q)
+            for _ in range(detect_workers)
+        ],
+    )
+    write_threads = start_stage(
+        write_worker, [(dynamodb.Table(dynamodb_table_name),) for _ in range(write_workers)]
+    )
 
+    # Single-PUT uploads are signed here, serially, as images are queued; signing
+    # is local CPU work and keeps the upload workers down to raw HTTP. Jobs carry
+    # paths, not open files: a file is only opened by the stage that reads it, so
+    # queued images do not hold file descriptors. A failure here only drops that
+    # image; the stages must still be drained below so buffered writes are flushed.
+    for image in images:
+        try:
+            s3_key = s3_key_for(image)
+            presigned_url = None
+            if image.stat().st_size < MULTIPART_THRESHOLD:
+                presigned_url = presign_upload_url(s3_client, s3_bucket, s3_key)
         except Exception as exc:
-            print(f"❌ Failed processing {image.name}: {exc}")
+            logger.error("❌ Failed processing %s: %s", image.name, exc)
+            continue
+
+        upload_q.put({"image": image, "s3_key": s3_key, "presigned_url": presigned_url})
+
+    stop_stage(upload_q, upload_threads)
+    stop_stage(detect_q, detect_threads)
+    stop_stage(write_q, write_threads)
+
+    # Progress goes to stderr via logging; stdout carries one compact JSON document
+    # with every record, written in a single call.
+    results.sort(key=lambda r: r["filename"])
+    sys.stdout.write(json.dumps(results, separators=(",", ":"), default=str) + "\n")
 
 
 if __name__ == "__main__":